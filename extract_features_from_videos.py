@@ -1,8 +1,10 @@
 import os
+import weakref
 from pathlib import Path
 import argparse
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
-from natsort import natsorted
 import numpy as np
 import torch
 
@@ -12,21 +14,70 @@ from src.utils.video import (
     from_frames_to_clips,
     load_rgb_batch,
     split_clip_indices_into_batches,
-    extract_frames_from_video,
+    VideoFrameReader,
+    open_video_decoder,
 )
 from time import perf_counter
 
 
+# captured forward passes (with their static input and output) by model and input shape,
+# the graphs of a model are released together with it
+model_cuda_graphs = weakref.WeakKeyDictionary()
+
+
+def get_cuda_graph(model, inp, use_amp):
+    # the input shape is fixed, so the forward is captured only once for all the videos
+    cuda_graphs = model_cuda_graphs.setdefault(model, {})
+    key = (inp.shape, inp.dtype, use_amp)
+    if key not in cuda_graphs:
+        static_in = inp.clone()
+        autocast = lambda: torch.autocast(
+            "cuda", dtype=torch.float16, enabled=use_amp, cache_enabled=False
+        )
+
+        # warm up on a side stream (cudnn benchmark, lazy inits) before capturing
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream), torch.no_grad(), autocast():
+            model({"frames": static_in})
+        torch.cuda.current_stream().wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph), torch.no_grad(), autocast():
+            static_out = model({"frames": static_in}).flatten(1)
+        cuda_graphs[key] = (graph, static_in, static_out)
+    return cuda_graphs[key]
+
+
+# features buffer reused by all the videos (by dtype), grown only for longer videos
+feature_buffers = {}
+
+
+def get_feature_buffer(shape, dtype, device):
+    n_elements = int(np.prod(shape))
+    buffer = feature_buffers.get(dtype)
+    if buffer is None or buffer.numel() < n_elements:
+        # release the smaller buffer before allocating the new one
+        buffer = feature_buffers[dtype] = None
+        buffer = torch.empty(n_elements, dtype=dtype, device=device)
+        feature_buffers[dtype] = buffer
+    return buffer[:n_elements].view(shape)
+
+
 def extract_features(
-    model, feature, device, clip_length, temp_path, batch_size, n_crops
+    model,
+    feature,
+    device,
+    clip_length,
+    frames,
+    batch_size,
+    n_crops,
+    use_amp,
+    use_cuda_graph,
+    forward_size=None,
 ):
-    # rgb files
-    rgb_files = natsorted(
-        [i for i in os.listdir(temp_path)]
-    )  # [:480000] # only for ucf-crime long videos
-
     # creating clips
-    frame_indices = from_frames_to_clips(rgb_files, clip_length)
+    frame_indices = from_frames_to_clips(frames, clip_length)
 
     # divide clips into batches (for memory optimization)
     # k = true values in the last batch
@@ -38,50 +89,121 @@ def extract_features(
 
     # 1024 if inception-v1 or 2048 if resnet50 and 4096 if C3D
     feat_vec_dim = 1024 if feature == "I3D" else 4096
-    full_features = torch.zeros(
-        (n_batches, n_crops, n_clips_inside_a_batch, feat_vec_dim), device=device
+    # mixed precision (FP16) is used only on the GPU, features are stored in FP16 too
+    use_amp = use_amp and device.type == "cuda"
+    use_cuda_graph = use_cuda_graph and device.type == "cuda"
+    # NOTE: every row is written by a batch (padded clips too), no need to zero it
+    full_features = get_feature_buffer(
+        (n_batches, n_clips_inside_a_batch, n_crops, feat_vec_dim),
+        torch.float16 if use_amp else torch.float32,
+        device,
     )
 
-    for batch_id in range(n_batches):
-        # B=16 x T=16 x CROP=10 x CH=3 x H x W
-        batch_data = load_rgb_batch(
-            temp_path, rgb_files, frame_indices[batch_id], feature, device, n_crops
+    # by default all the B*CROP inputs of a batch are processed by a single forward,
+    # on small GPUs they are split into chunks of equal size (so a single CUDA graph
+    # replays all of them) of at most forward_size inputs
+    n_inputs = n_clips_inside_a_batch * n_crops
+    forward_size = max(1, min(forward_size or n_inputs, n_inputs))
+    while n_inputs % forward_size != 0:
+        forward_size -= 1
+
+    # load the next batch in background while the model runs on the current one,
+    # alternating two staging buffers (slots)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        load_batch = lambda batch_id: executor.submit(
+            load_rgb_batch,
+            frames,
+            frame_indices[batch_id],
+            feature,
+            device,
+            n_crops,
+            batch_id % 2,
         )
 
-        # iterate 10-crop augmentation
-        n_crops = batch_data.shape[2]
-        for i in range(n_crops):
-            b_data = batch_data[:, :, i, :, :, :]  # select the i-crop
-            b_data = b_data.transpose(1, 2)  # B=16 x CH=3 x T=16 x H x W
-
-            with torch.no_grad():
-                inp = {"frames": b_data}
-                features = model(inp).squeeze()
+        next_batch = load_batch(0)
+        for batch_id in range(n_batches):
+            # B=16 x CROP=10 x CH=3 x T=16 x H x W
+            batch_data, ready = next_batch.result()
+            if ready is not None:
+                # the batch was loaded on the loader stream, wait for it on the GPU
+                torch.cuda.current_stream().wait_event(ready)
+                batch_data.record_stream(torch.cuda.current_stream())
+
+            # fold the 10-crop augmentation into the batch, the crops are processed
+            # in chunks of the inputs: B*CROP=160 x CH=3 x T=16 x H x W
+            # NOTE: the crops are loaded in this layout, so this is only a view
+            b_data = batch_data.flatten(0, 1)
+
+            # NOTE: the graph is captured before loading the next batch in background
+            if use_cuda_graph:
+                graph, static_in, static_out = get_cuda_graph(
+                    model, b_data[:forward_size], use_amp
+                )
+
+            if batch_id + 1 < n_batches:
+                next_batch = load_batch(batch_id + 1)
+
+            # B x CROP x F -> B*CROP x F
+            batch_features = full_features[batch_id].view(n_inputs, feat_vec_dim)
+            for i in range(0, n_inputs, forward_size):
+                inp = b_data[i : i + forward_size]
+
+                if use_cuda_graph:
+                    # replay the captured forward on the static input
+                    static_in.copy_(inp)
+                    graph.replay()
+                    features = static_out
+                else:
+                    with torch.no_grad(), torch.autocast(
+                        device.type, dtype=torch.float16, enabled=use_amp
+                    ):
+                        features = model({"frames": inp}).flatten(1)
+
+                batch_features[i : i + forward_size] = features
+
+    # from fixed tensor to N x CROP x F, ignoring the padded clips in the last batch
+    n_clips = (n_batches - 1) * n_clips_inside_a_batch + k
+
+    # NOTE: the frame count stored in the container can be overestimated, the clips
+    # after the end of the video are dropped
+    if isinstance(frames, VideoFrameReader) and frames.ended:
+        n_frames = frames.n_frames
+        n_clips = min(n_clips, len(from_frames_to_clips(range(n_frames), clip_length)))
+    out = full_features.view(-1, n_crops, feat_vec_dim)[:n_clips]
+
+    out = out.cpu().numpy().astype(np.float32)
+    return out
 
-            full_features[batch_id, i, :, :] = features
 
-    full_features = full_features.cpu().numpy()
+def setup_model(feature, compile_model, use_cuda_graph):
+    # set up the model
+    torch.backends.cudnn.benchmark = True
+    torch.cuda.empty_cache()
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-    # from fixed tensor to variable length list
-    out = [[] for i in range(n_crops)]
-    for batch_id in range(n_batches):
-        for i in range(n_crops):
-            if batch_id == n_batches - 1:
-                # ignore padded values in the last batch
-                out[i].append(full_features[batch_id, i, :k, :])
-            else:
-                out[i].append(full_features[batch_id, i, :, :])
+    if feature == "I3D":
+        model = i3d_model(nb_classes=400, pretrainedpath="models/rgb_imagenet.pt")
+    else:
+        model = c3d_model(
+            nb_classes=487, pretrainedpath="models/c3d.pickle", feature_layer=6
+        )
 
-    out = [np.concatenate(i, axis=0) for i in out]
-    out = [np.expand_dims(i, axis=0) for i in out]
-    out = np.concatenate(out, axis=0)
+    model.to(device)  # Put model to GPU
+    model.train(False)  # Set model to evaluate mode
 
-    out = np.array(out).transpose([1, 0, 2])
-    return out
+    # the input shape is fixed (B*CROP x CH x T x H x W), the model is compiled
+    # once with the first batch and the graph is reused for all the videos
+    # NOTE: with CUDA graphs the compiled model captures them itself
+    if compile_model and device.type == "cuda":
+        mode = "reduce-overhead" if use_cuda_graph else None
+        model = torch.compile(model, mode=mode, fullgraph=True, dynamic=False)
+    return model, device
 
 
-def generate(
-    dataset_path,
+def process_video(
+    model,
+    device,
+    video,
     output_path,
     feature,
     clip_size,
@@ -89,101 +211,214 @@ def generate(
     video_format_type,
     n_crops,
     save_single_crops,
+    use_amp,
+    use_cuda_graph,
+    gpu_decode,
+    forward_size,
 ):
-    Path(output_path).mkdir(parents=True, exist_ok=True)
-    temp_path = output_path + "/temp/"
-    root_dir = Path(dataset_path)
-    videos = [str(f) for f in root_dir.glob("**/*{}".format(video_format_type))]
+    print(f"current video: {video}")
+
+    # start the stopwatch to mesure the video opening time
+    # NOTE: the frames are decoded lazily, batch by batch, during the features
+    # extraction, so the decoding time is included in the features extraction time
+    t1_start = perf_counter()
+
+    if gpu_decode:
+        # the frames are decoded on the GPU batch by batch during the extraction
+        frames = open_video_decoder(video, device)
+        frame_count = len(frames)
+        frame_res = (frames.metadata.height, frames.metadata.width, 3)
+    else:
+        # the frames are decoded on the CPU batch by batch during the extraction
+        frames = VideoFrameReader(video, clip_size)
+        frame_count, frame_res = len(frames), frames.shape[1:]
 
-    # set up the model
-    torch.backends.cudnn.benchmark = True
-    torch.cuda.empty_cache()
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    t1_elapsed = perf_counter() - t1_start
+    print(
+        f"video opened, {frame_count} frames with shape {frame_res}, time elapsed: {t1_elapsed:.2f} s"
+    )
 
-    if feature == "I3D":
-        model = i3d_model(nb_classes=400, pretrainedpath="models/rgb_imagenet.pt")
+    # start the stopwatch to mesure the features extraction time (decoding included)
+    t2_start = perf_counter()
+
+    # extract features from the extracted frames of a video
+    features = extract_features(
+        model,
+        feature,
+        device,
+        clip_size,
+        frames,
+        batch_size,
+        n_crops,
+        use_amp,
+        use_cuda_graph,
+        forward_size,
+    )
+
+    t2_elapsed = perf_counter() - t2_start
+    print(
+        f"frames decoded and features extracted with shape {features.shape}, time elapsed: {t2_elapsed:.2f} s"
+    )
+
+    # save features
+    video_name = video.split("/")[-1].split(video_format_type)[0]
+    if save_single_crops:
+        for i in range(n_crops):
+            feature_filename = output_path + "/" + video_name + "__" + str(i)
+            np.save(feature_filename, features[:, i, :])
+            print("features saved as {}".format(feature_filename + ".npy"))
     else:
-        model = c3d_model(
-            nb_classes=487, pretrainedpath="models/c3d.pickle", feature_layer=6
-        )
+        feature_filename = output_path + "/" + video_name
+        np.save(feature_filename, features)
+        print("features saved as {}".format(feature_filename + ".npy"))
 
-    model.to(device)  # Put model to GPU
-    model.train(False)  # Set model to evaluate mode
+    return t1_elapsed, t2_elapsed, frame_res
 
-    # create temp folder
-    Path(temp_path).mkdir(parents=True, exist_ok=True)
 
-    # list of corrupted files to discard
-    discard_list = ["v=8cTqh9tMz_I__#1_label_A"]
+# model of a worker process, loaded with its first video
+worker_model = None
+worker_device = None
+worker_model_args = ()
 
-    avg_frames_extraction_time = []  # list for estimate avg frames extraction time
-    avg_features_extraction_time = []  # list for estimate avg features extraction time
-    avg_frame_res = []  # list for estimate avg frame resolution
 
-    k = 1
-    for video in videos:
-        # remove files into temp folder
-        for f in Path(temp_path).glob("**/*"):
-            os.remove(f)
+def init_worker(gpu_ids, model_args):
+    global worker_model_args
+    worker_model_args = model_args
 
-        # discard files mentioned in the discard_list
-        if video.split("/")[-1].split(video_format_type)[0] in discard_list:
-            continue
+    # pin the worker process to a single GPU before CUDA is initialized
+    gpu_id = gpu_ids.get()
+    if gpu_id is not None:
+        os.environ["CUDA_VISIBLE_DEVICES"] = gpu_id
 
-        print(f"current video: {video}")
 
-        # start the stopwatch to mesure the frames extraction time
-        t1_start = perf_counter()
+def process_video_in_worker(video, output_path, feature, *args):
+    global worker_model, worker_device
 
-        # splitting the video into frames and saving them as images to an output folder
-        frame_count, frame_res = extract_frames_from_video(video, temp_path)
+    # each worker process keeps its own copy of the model for all its videos
+    if worker_model is None:
+        worker_model, worker_device = setup_model(feature, *worker_model_args)
 
-        t1_elapsed = perf_counter() - t1_start
-        avg_frames_extraction_time.append(t1_elapsed)
-        avg_frame_res.append(frame_res)
-        print(
-            f"{frame_count} frames extracted with shape {frame_res}, time elapsed: {t1_elapsed:.2f} s"
-        )
+    return process_video(
+        worker_model, worker_device, video, output_path, feature, *args
+    )
 
-        # start the stopwatch to mesure the features extraction time
-        t2_start = perf_counter()
 
-        # extract features from the extracted frames of a video
-        features = extract_features(
-            model, feature, device, clip_size, temp_path, batch_size, n_crops
-        )
+def process_videos_in_parallel(videos, n_workers, model_args, *args):
+    # NOTE: CUDA can't be used in forked processes, workers are spawned
+    context = multiprocessing.get_context("spawn")
 
-        t2_elapsed = perf_counter() - t2_start
-        avg_features_extraction_time.append(t2_elapsed)
-        print(
-            f"features extracted with shape {features.shape}, time elapsed: {t2_elapsed:.2f} s"
-        )
+    # workers are assigned in round robin to the GPUs visible to this process
+    # NOTE: the ids are taken from CUDA_VISIBLE_DEVICES, so that the workers don't
+    # end up on GPUs the user excluded
+    n_gpus = torch.cuda.device_count()
+    visible_devices = os.environ.get("CUDA_VISIBLE_DEVICES")
+    if visible_devices is not None:
+        visible_devices = [d.strip() for d in visible_devices.split(",")][:n_gpus]
+    else:
+        visible_devices = [str(i) for i in range(n_gpus)]
+
+    gpu_ids = context.Queue()
+    for i in range(n_workers):
+        gpu_ids.put(visible_devices[i % n_gpus] if n_gpus > 0 else None)
+
+    with ProcessPoolExecutor(
+        max_workers=n_workers,
+        mp_context=context,
+        initializer=init_worker,
+        initargs=(gpu_ids, model_args),
+    ) as executor:
+        futures = [
+            executor.submit(process_video_in_worker, video, *args) for video in videos
+        ]
+        for future in as_completed(futures):
+            yield future.result()
 
-        # save features
-        video_name = video.split("/")[-1].split(video_format_type)[0]
-        if save_single_crops:
-            for i in range(n_crops):
-                feature_filename = output_path + "/" + video_name + "__" + str(i)
-                np.save(feature_filename, features[:, i, :])
-                print("features saved as {}".format(feature_filename + ".npy"))
-        else:
-            feature_filename = output_path + "/" + video_name
-            np.save(feature_filename, features)
-            print("features saved as {}".format(feature_filename + ".npy"))
+
+def generate(
+    dataset_path,
+    output_path,
+    feature,
+    clip_size,
+    batch_size,
+    video_format_type,
+    n_crops,
+    save_single_crops,
+    use_amp,
+    gpu_decode,
+    n_workers,
+    compile_model,
+    use_cuda_graph,
+    forward_size,
+):
+    Path(output_path).mkdir(parents=True, exist_ok=True)
+    root_dir = Path(dataset_path)
+    videos = [str(f) for f in root_dir.glob("**/*{}".format(video_format_type))]
+
+    # list of corrupted files to discard
+    discard_list = ["v=8cTqh9tMz_I__#1_label_A"]
+    videos = [
+        video
+        for video in videos
+        if video.split("/")[-1].split(video_format_type)[0] not in discard_list
+    ]
+
+    # the compiled model captures the CUDA graphs by itself
+    model_args = (compile_model, use_cuda_graph)
+    args = (
+        output_path,
+        feature,
+        clip_size,
+        batch_size,
+        video_format_type,
+        n_crops,
+        save_single_crops,
+        use_amp,
+        use_cuda_graph and not compile_model,
+        gpu_decode,
+        forward_size,
+    )
+
+    # by default one worker process for each GPU
+    if n_workers is None:
+        n_workers = max(torch.cuda.device_count(), 1)
+
+    if n_workers > 1:
+        results = process_videos_in_parallel(videos, n_workers, model_args, *args)
+    else:
+        model, device = setup_model(feature, *model_args)
+        results = (process_video(model, device, video, *args) for video in videos)
+
+    avg_video_opening_time = []  # list for estimate avg video opening time
+    # list for estimate avg features extraction time (frames decoding included)
+    avg_features_extraction_time = []
+    avg_frame_res = []  # list for estimate avg frame resolution
+
+    for k, (t1_elapsed, t2_elapsed, frame_res) in enumerate(results, start=1):
+        avg_video_opening_time.append(t1_elapsed)
+        avg_features_extraction_time.append(t2_elapsed)
+        avg_frame_res.append(frame_res)
 
         total_elapsed = t1_elapsed + t2_elapsed
         print(
             f"videos processed: {k} / {len(videos)}, time elapsed: {total_elapsed:.2f} s \n"
         )
-        k += 1
 
     avg_frame_res = np.asarray(avg_frame_res).mean(0)
-    avg_frames_extraction_time = np.asarray(avg_frames_extraction_time).mean()
+    avg_video_opening_time = np.asarray(avg_video_opening_time).mean()
     avg_features_extraction_time = np.asarray(avg_features_extraction_time).mean()
 
     print(f"avg frame resolution: {avg_frame_res} s")
-    print(f"avg frames extraction time: {avg_frames_extraction_time} s")
-    print(f"avg features extraction time: {avg_features_extraction_time} s")
+    print(f"avg video opening time: {avg_video_opening_time} s")
+    print(
+        f"avg features extraction time (frames decoding included): {avg_features_extraction_time} s"
+    )
+
+
+def positive_int(value):
+    value = int(value)
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive integer")
+    return value
 
 
 # dataset-path:
@@ -208,6 +443,16 @@ if __name__ == "__main__":
     parser.add_argument("--video_format_type", type=str, default=".mp4")
     parser.add_argument("--n_crops", type=int, default=10)  # 10, 5
     parser.add_argument("--save_single_crops", type=bool, default=False)  # False, True
+    parser.add_argument("--use_amp", action="store_true")  # FP16 inference on the GPU
+    parser.add_argument("--gpu_decode", action="store_true")  # requires torchcodec
+    parser.add_argument("--n_workers", type=int, default=None)  # default: n. of GPUs
+    parser.add_argument("--compile", action="store_true")  # torch.compile the model
+    parser.add_argument(
+        "--cuda_graph", action="store_true"
+    )  # replay the forward as a CUDA graph on the GPU
+    parser.add_argument(
+        "--forward_size", type=positive_int, default=None
+    )  # default: batch_size * n_crops (a single forward for each batch)
     args = parser.parse_args()
     generate(
         args.dataset_path,
@@ -218,4 +463,10 @@ if __name__ == "__main__":
         args.video_format_type,
         args.n_crops,
         args.save_single_crops,
+        args.use_amp,
+        args.gpu_decode,
+        args.n_workers,
+        args.compile,
+        args.cuda_graph,
+        args.forward_size,
     )
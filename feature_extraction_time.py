@@ -85,13 +85,11 @@ with torch.no_grad():
         processed_clip = processed_clip.unsqueeze(0)
         processed_clip = processed_clip.to(device)
 
-        # extract clip-level features
+        # extract clip-level features, all the crops in a single forward
         # I3D shape with ten crops: ([1, 16, 10, 3, 224, 224])
-        # I3D shape just one crop: (1, 3, 16, 224, 224)
-        for j in range(processed_clip.shape[2]):
-            input = processed_clip[:, :, j, :, :, :]
-            input = input.transpose(1, 2)
-            features = model({"frames": input}).squeeze()
+        # I3D shape of the crops batch: (10, 3, 16, 224, 224)
+        input = processed_clip[0].permute(1, 2, 0, 3, 4)
+        features = model({"frames": input}).flatten(1)
 
         ender.record()
 
@@ -1,9 +1,10 @@
+import functools
+
 import numpy as np
 import torch
-import cv2
+import torch.nn.functional as F
 
 from opencv_transforms import transforms as cv_t
-from concurrent.futures import ThreadPoolExecutor
 from deprecation import deprecated
 
 sports1m_mean = np.load("data/c3d_mean.npy")
@@ -58,19 +59,24 @@ def i3d_normalization(tensor):
     return tensor
 
 
-def read_frame(frame_path, use_rgb=False):
-    # read a single frame image
-    frame = cv2.imread(frame_path)
+@functools.lru_cache()
+def crop_augmentation_i3d(patch_size, n_crops=10):
+    """Build the 10/5 crop data augmentation for I3D only once for each configuration"""
 
-    # Grayscale frames are converted in RGB frames by repeating the same channel
-    if len(frame.shape) <= 2:
-        frame = cv2.merge([frame, frame, frame])
+    # transforms applied to single crops
+    crop_transform = cv_t.Compose(
+        [
+            cv_t.ToTensor(),
+            i3d_normalization,
+        ]
+    )
+    return CropAugmentationFrame(patch_size, n_crops, crop_transform=crop_transform)
 
-    # NOTE: opencv read images in BGR format
-    if use_rgb:
-        frame = frame[:, :, [2, 1, 0]]  # from BGR to RGB
 
-    return frame
+@functools.lru_cache()
+def crop_augmentation_c3d(patch_size, n_crops=10):
+    """Build the 10/5 crop data augmentation for C3D only once for each configuration"""
+    return CropAugmentationFrame(patch_size, n_crops, crop_transform=cv_t.ToTensor())
 
 
 def transform_frame_i3d(frame, patch_size, n_crops=10):
@@ -86,17 +92,8 @@ def transform_frame_i3d(frame, patch_size, n_crops=10):
     if frame.shape[0] < 226 or frame.shape[1] < 226:
         frame = cv_t.Resize(226)(frame)
 
-    # transforms applied to single crops
-    crop_transform = cv_t.Compose(
-        [
-            cv_t.ToTensor(),
-            i3d_normalization,
-        ]
-    )
     # 10/5 crop data augmentation
-    transform = CropAugmentationFrame(
-        patch_size, n_crops, crop_transform=crop_transform
-    )
+    transform = crop_augmentation_i3d(patch_size, n_crops)
     frame = transform(frame)
     return frame
 
@@ -120,16 +117,15 @@ def transform_clip_from_frames_c3d(frames, patch_size, n_crops):
 
     # resize all 16 j-frames of the clip-i
     resized_frames = np.zeros((n_frames, H, W, CH), dtype=np.float32)
+    resize = cv_t.Resize((H, W))
     for j in range(n_frames):
-        resized_frames[j] = cv_t.Resize((H, W))(frames[j])
+        resized_frames[j] = resize(frames[j])
 
     # mean-subtraction normalization sports-1m
     resized_frames = resized_frames - sports1m_mean
 
     processed_frames = torch.zeros((n_frames, n_crops, CH, patch_size, patch_size))
-    transform = CropAugmentationFrame(
-        patch_size, n_crops, crop_transform=cv_t.ToTensor()
-    )
+    transform = crop_augmentation_c3d(patch_size, n_crops)
 
     # crop patches of 112x112 for all 16 j-frames of the clip-i
     for j in range(n_frames):
@@ -138,38 +134,147 @@ def transform_clip_from_frames_c3d(frames, patch_size, n_crops):
     return processed_frames
 
 
-def transform_clip_from_paths_c3d(frames_path, patch_size, n_crops):
-    n_frames = len(frames_path)
-    frames = np.zeros((n_frames, 128, 171, 3))
-
-    # read and resize all 16 j-frames of the clip-i
-    for j in range(n_frames):
-        frame = read_frame(frames_path[j])
-        frames[j] = cv_t.Resize((128, 171))(frame)
+@functools.lru_cache()
+def sports1m_mean_tensor(device):
+    """Return the Sports-1M mean clip as a T x C x H x W tensor stored on the device"""
+    return torch.from_numpy(sports1m_mean.transpose(0, 3, 1, 2).copy()).to(device)
 
-    # mean-subtraction normalization sports-1m
-    frames = np.asarray(frames, dtype=np.float32)
-    frames = frames - sports1m_mean
 
-    processed_frames = torch.zeros((n_frames, n_crops, 3, patch_size, patch_size))
-    transform = CropAugmentationFrame(
-        patch_size, n_crops, crop_transform=cv_t.ToTensor()
-    )
+def resize_frames(frames, size):
+    """Tensor version of cv_t.Resize for a batch of frames N x C x H x W, an int size
+    resizes the smaller edge keeping the aspect ratio"""
+    h, w = frames.shape[-2:]
 
-    # crop patches of 112x112 for all 16 j-frames of the clip-i
-    for j in range(n_frames):
-        processed_frames[j] = transform(frames[j])
+    if isinstance(size, int):
+        if (w <= h and w == size) or (h <= w and h == size):
+            return frames
+        if w < h:
+            size = (int(size * h / w), size)
+        else:
+            size = (size, int(size * w / h))
 
-    return processed_frames
+    # NOTE: same sampling of cv2.INTER_LINEAR (half-pixel centers, no antialiasing)
+    return F.interpolate(frames, size=size, mode="bilinear", align_corners=False)
 
 
-def transform_clip_from_paths_i3d(frames_path, patch_size, use_rgb, n_crops):
-    def process_frame(frame_path):
-        frame = read_frame(frame_path, use_rgb)
+@functools.lru_cache(maxsize=4)
+def crop_indices(
+    n_ch, h, w, patch_size, n_crops, device, channels_last=False, flip_channels=False
+):
+    """Return the indices of the 10/5 crops (as cv_t.TenCrop / cv_t.FiveCrop) inside a
+    flattened frame C x H x W (H x W x C if channels_last), built only once for each
+    frame resolution. If flip_channels the channels of the crops are reversed"""
+    # top-left, top-right, bottom-left, bottom-right and center crops
+    offsets = torch.tensor(
+        [
+            (0, 0),
+            (0, w - patch_size),
+            (h - patch_size, 0),
+            (h - patch_size, w - patch_size),
+            (int(round((h - patch_size) / 2.0)), int(round((w - patch_size) / 2.0))),
+        ]
+    )
+    rows = offsets[:, 0, None] + torch.arange(patch_size)  # CROP x P
+    cols = offsets[:, 1, None] + torch.arange(patch_size)  # CROP x P
+
+    # crops of the horizontally flipped frame, reading the columns from right to left
+    if n_crops == 10:
+        rows = torch.cat([rows, rows])
+        cols = torch.cat([cols, (w - 1) - cols])
+
+    channels = torch.arange(n_ch)
+    if flip_channels:
+        channels = channels.flip(0)  # e.g. from BGR to RGB
+
+    # CROP x C x P x P
+    if channels_last:
+        indices = (
+            channels[None, :, None, None]
+            + rows[:, None, :, None] * w * n_ch
+            + cols[:, None, None, :] * n_ch
+        )
+    else:
+        indices = (
+            channels[None, :, None, None] * h * w
+            + rows[:, None, :, None] * w
+            + cols[:, None, None, :]
+        )
+    return indices.to(device)
+
+
+def crop_clips(
+    clips, patch_size, n_crops=10, channels_last=False, flip_channels=False
+):
+    """Tensor version of cv_t.TenCrop / cv_t.FiveCrop for a batch of clips B x T x C x H x W
+    (B x T x H x W x C if channels_last), return the crops already in the model layout
+    B x CROP x C x T x patch_size x patch_size"""
+    if channels_last:
+        n_frames, h, w, n_ch = clips.shape[1:]
+    else:
+        n_frames, n_ch, h, w = clips.shape[1:]
+    indices = crop_indices(
+        n_ch, h, w, patch_size, n_crops, clips.device, channels_last, flip_channels
+    )
+    frame_ids = torch.arange(n_frames, device=clips.device)[:, None, None]
+
+    # all the crops are gathered at once, no flipped copy of the frames is made,
+    # the frame and pixel indices are broadcast to CROP x C x T x P x P
+    return clips.flatten(2)[:, frame_ids, indices[:, :, None]]
+
+
+def transform_clips_i3d(clips, patch_size, n_crops=10, bgr=True):
+    """Given a batch of clips B x T x H x W x C (uint8 BGR frames read by opencv, or RGB
+    if not bgr) return the preprocessed batch B x CROP x C x T x H x W on the device of
+    the clips"""
+    n_clips, n_frames, h, w, ch = clips.shape
+
+    # 10/5 crop data augmentation, BGR frames are turned into RGB by the crop indices
+    if h < 226 or w < 226:
+        # ensure the resolution for cropping (see transform_frame_i3d)
+        frames = clips.reshape(-1, h, w, ch).permute(0, 3, 1, 2)
+        frames = frames.to(torch.float, memory_format=torch.contiguous_format).div_(255)
+        frames = resize_frames(frames, 226)
+        frames = frames.view(n_clips, n_frames, *frames.shape[1:])
+        frames = crop_clips(frames, patch_size, n_crops, flip_channels=bgr)
+    else:
+        # the crops are gathered from the uint8 frames as they are, so only the
+        # crops (not the full resolution frames) are copied and cast to float
+        frames = crop_clips(
+            clips, patch_size, n_crops, channels_last=True, flip_channels=bgr
+        )
+        frames = frames.to(torch.float).div_(255)
+
+    # pixel values are rescaled between -1 and 1 (see i3d_normalization)
+    return frames.mul_(2).sub_(1)
+
+
+def transform_clips_c3d(clips, patch_size, n_crops=10, bgr=True):
+    """Given a batch of clips B x T x H x W x C (uint8 BGR frames read by opencv, or RGB
+    if not bgr) return the preprocessed batch B x CROP x C x T x H x W on the device of
+    the clips"""
+    n_clips, n_frames, h, w, ch = clips.shape
+    H = 128
+    W = 171
 
-        return transform_frame_i3d(frame, patch_size, n_crops)
+    # the decoded frames are kept channels last (N x H x W x C in memory) until resized,
+    # the full resolution frames are only cast to float and never transposed
+    # NOTE: frames are cast and resized one clip at a time, so that only T full
+    # resolution frames at once are held in float on the device
+    frames = clips.reshape(-1, h, w, ch).permute(0, 3, 1, 2)
+    resized = torch.empty((len(frames), ch, H, W), device=clips.device)
+    for i in range(0, len(frames), n_frames):
+        chunk = frames[i : i + n_frames]
+        chunk = chunk.to(torch.float, memory_format=torch.channels_last)
+        resized[i : i + n_frames] = resize_frames(chunk, (H, W))
+    frames = resized
+
+    # the mean is BGR, RGB frames are flipped only once resized
+    if not bgr:
+        frames = frames.flip(1)
 
-    with ThreadPoolExecutor(max_workers=8) as executor:
-        processed_frames = list(executor.map(process_frame, frames_path))
+    # mean-subtraction normalization sports-1m
+    frames = frames.view(n_clips, n_frames, ch, H, W)
+    frames = frames - sports1m_mean_tensor(clips.device)
 
-    return torch.stack(processed_frames)
+    # crop patches of 112x112 for all 16 j-frames of the clip-i
+    return crop_clips(frames, patch_size, n_crops)
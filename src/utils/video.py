@@ -1,46 +1,91 @@
 import numpy as np
 import torch
-import os
 import cv2
 
-from concurrent.futures import ThreadPoolExecutor, wait, ALL_COMPLETED
-
-from src.utils.transforms import (
-    transform_clip_from_paths_c3d,
-    transform_clip_from_paths_i3d,
-)
-
-
-def extract_frames_from_video(video_name, output_dir):
-    cap = cv2.VideoCapture(video_name)
-    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    frame_res = np.asarray(cap.read()[1]).shape
-
-    if frame_count == 0:
+from src.utils.transforms import transform_clips_c3d, transform_clips_i3d
+
+try:
+    from torchcodec.decoders import VideoDecoder
+except ImportError:
+    VideoDecoder = None  # GPU decoding is optional
+
+
+class VideoFrameReader:
+    """Decode the frames of a video with opencv on demand, in order: only the frames of
+    the clips not processed yet are kept in memory, so long videos don't have to fit
+    in RAM. The frames are N x H x W x C uint8 BGR arrays"""
+
+    def __init__(self, video_name, step=16):
+        self.cap = cv2.VideoCapture(video_name)
+        frame_count = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+
+        if frame_count == 0:
+            exit("Video file not found")
+
+        height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.shape = (frame_count, height, width, 3)
+
+        # frames used by at least one clip, the others are skipped without retrieving them
+        self.needed = np.zeros(frame_count, dtype=bool)
+        clip_indices = from_frames_to_clips(range(frame_count), step)
+        self.needed[clip_indices.ravel()] = True
+
+        self.frames = {}  # retrieved frames by index, until no clip needs them
+        self.position = 0  # index of the next frame of the stream
+        self.n_frames = 0  # frames actually decoded
+        self.ended = False  # the stream ended before the frame count
+        self.last_frame = None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def take(self, frame_indices, out=None):
+        """Return the frames at the given indices (as np.take), the clips have to be
+        requested in order since the frames before them are released"""
+        last = int(frame_indices.max())
+        while self.position <= last:
+            # grab() only advances the stream, retrieve() converts the grabbed frame
+            # NOTE: the frame count stored in the container can be overestimated,
+            # the missing frames repeat the last retrieved one
+            if not self.ended and self.cap.grab():
+                self.n_frames += 1
+                if self.needed[self.position]:
+                    self.last_frame = self.cap.retrieve()[1]
+            else:
+                self.ended = True
+            if self.needed[self.position]:
+                self.frames[self.position] = self.last_frame
+            self.position += 1
+
+        if out is None:
+            out = np.empty(frame_indices.shape + self.shape[1:], dtype=np.uint8)
+        frames = out.reshape(-1, *self.shape[1:])
+        for i, index in enumerate(frame_indices.ravel()):
+            frames[i] = self.frames[index]
+
+        # the following clips start after the first frame of the last clip
+        first = int(frame_indices.reshape(-1, frame_indices.shape[-1])[-1].min())
+        for index in [index for index in self.frames if index < first]:
+            del self.frames[index]
+        return out
+
+    def __del__(self):
+        self.cap.release()
+
+
+def open_video_decoder(video_name, device):
+    """Return a torchcodec decoder of the video, the frames are decoded on demand
+    directly on the given device (NVDEC if cuda) as N x H x W x C uint8 RGB tensors"""
+    if VideoDecoder is None:
+        exit("GPU decoding requires torchcodec (pip install torchcodec)")
+
+    decoder = VideoDecoder(video_name, dimension_order="NHWC", device=str(device))
+
+    if len(decoder) == 0:
         exit("Video file not found")
 
-    batch_size = 2**12  # how many frames to save in parallel
-    batches = list(divide_chunks([0 for _ in range(frame_count)], batch_size))
-
-    k = 0
-    for i in range(len(batches)):
-        frames_to_save = []
-        frames_paths = []
-        for j in range(len(batches[i])):
-            frames_to_save.append(cap.read()[1])
-            frames_paths.append(os.path.join(output_dir, "image%d.jpg" % k))
-            k = k + 1
-
-        max_workers = 8
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            f = lambda x: cv2.imwrite(x[0], x[1])
-            futures = list(
-                map(lambda x: executor.submit(f, x), zip(frames_paths, frames_to_save))
-            )
-            wait(futures, return_when=ALL_COMPLETED)
-
-    cap.release()
-    return frame_count, frame_res
+    return decoder
 
 
 def read_video(video_path, use_rgb=False, transform_frame=None):
@@ -85,61 +130,89 @@ def from_frames_to_clips(frames, step=16):
     frame_cnt = len(frames)
     stack_depth = 16
 
-    frame_indices = []  # Frames to chunks
-    frame_ticks = range(1, frame_cnt + 1, step)
-    for tick in frame_ticks:  # for clip in frames
-        # frame indices for a clip
-        frame_idx = [min(frame_cnt, tick + offset) for offset in range(stack_depth)]
-        frame_indices.append(frame_idx)
-    return np.asarray(frame_indices, dtype=object) - 1  # indices start from 0
+    # the last clip is completed by repeating the last frame
+    frame_ticks = np.arange(frame_cnt)
+    frame_ticks = np.pad(frame_ticks, (0, stack_depth - 1), mode="edge")
 
-
-def divide_chunks(l, n):
-    # looping till length l
-    for i in range(0, len(l), n):
-        yield l[i : i + n]
+    # frame indices for each clip (one window every step frames), indices start from 0
+    frame_indices = np.lib.stride_tricks.sliding_window_view(frame_ticks, stack_depth)
+    return frame_indices[::step]
 
 
 def split_clip_indices_into_batches(frame_indices, batch_size):
-    frame_indices = list(divide_chunks(list(frame_indices), batch_size))
+    n_clips, stack_depth = frame_indices.shape
+    pad = -n_clips % batch_size  # how many clip to fill
+    y = batch_size - pad  # number of clips inside the last batch
 
-    y = len(frame_indices[-1])  # number of clips inside the last batch
-    pad = batch_size - y  # how many clip to fill
+    # pad the last batch by repeating the last clip, then split into batches
+    frame_indices = np.pad(frame_indices, ((0, pad), (0, 0)), mode="edge")
+    frame_indices = frame_indices.reshape(-1, batch_size, stack_depth)
 
-    # pad the last batch with a number of (x - y) clips
-    # by repeating the last clip inside the last batch
-    last_batch = [clip for clip in frame_indices[-1]] + [frame_indices[-1][-1]] * pad
-    frame_indices[-1] = last_batch
+    return frame_indices.astype(np.uint32), y
 
-    return np.asarray(frame_indices, dtype=np.uint32), y
 
+# page-locked staging buffers (and the events of their last copy to the device) by slot
+pinned_buffers = {}
+
+
+def get_pinned_buffer(shape, slot=0):
+    # keep only the buffers for the current frame resolution
+    if slot not in pinned_buffers or pinned_buffers[slot][0].shape != shape:
+        pinned_buffers[slot] = (
+            torch.empty(shape, dtype=torch.uint8, pin_memory=True),
+            torch.cuda.Event(),
+        )
+    return pinned_buffers[slot]
 
-def load_rgb_batch(frames_dir, rgb_files, frame_indices, feature, device, n_crops):
-    # B=16 x T=16 x CROP=10 x CH=3 x H x W
-    patch_size = 224 if feature == "I3D" else 112
 
-    out = torch.zeros(
-        frame_indices.shape + (n_crops, 3, patch_size, patch_size), device=device
-    )
+# streams used to upload and preprocess the batches, apart from the model one
+loader_streams = {}
 
-    n_clips = frame_indices.shape[0]  # num of clips
-    n_frames = frame_indices.shape[1]  # num of frames inside a clip
 
-    for i in range(n_clips):
-        frames_path = [
-            os.path.join(frames_dir, rgb_files[frame_indices[i][j]])
-            for j in range(n_frames)
-        ]
+def load_rgb_batch(frames_buffer, frame_indices, feature, device, n_crops, slot=0):
+    """Return the preprocessed batch and, on the GPU, the event recorded when it is ready:
+    the batch is uploaded and preprocessed on a separate stream, so that it overlaps
+    with the forward of the previous batch"""
+    if device.type != "cuda":
+        batch = transform_rgb_batch(frames_buffer, frame_indices, feature, device, n_crops)
+        return batch, None
 
-        if feature == "I3D":
-            processed_frames = transform_clip_from_paths_i3d(
-                frames_path, patch_size, True, n_crops
-            )
-        else:
-            processed_frames = transform_clip_from_paths_c3d(
-                frames_path, patch_size, n_crops
-            )
+    if device not in loader_streams:
+        loader_streams[device] = torch.cuda.Stream(device)
 
-        out[i] = processed_frames
+    with torch.cuda.stream(loader_streams[device]):
+        batch = transform_rgb_batch(
+            frames_buffer, frame_indices, feature, device, n_crops, slot
+        )
+        ready = torch.cuda.Event()
+        ready.record()
+    return batch, ready
+
+
+def transform_rgb_batch(frames_buffer, frame_indices, feature, device, n_crops, slot=0):
+    patch_size = 224 if feature == "I3D" else 112
 
-    return out
+    # B=16 x T=16 x H x W x CH=3 (uint8 BGR frames, RGB if decoded by torchcodec)
+    bgr = isinstance(frames_buffer, VideoFrameReader)
+    if not bgr:
+        # torchcodec decoder, each needed frame is decoded once on the device and
+        # the decoded tensor is fed as it is to the preprocessing (no copy)
+        clips = frames_buffer.get_frames_at(frame_indices.ravel().tolist()).data
+        clips = clips.view(frame_indices.shape + clips.shape[1:])
+    elif device.type == "cuda":
+        shape = frame_indices.shape + frames_buffer.shape[1:]
+        buffer, copied = get_pinned_buffer(shape, slot)
+
+        # wait for the previous copy from the buffer before overwriting it
+        copied.synchronize()
+        frames_buffer.take(frame_indices, out=buffer.numpy())
+        clips = buffer.to(device, non_blocking=True)
+        copied.record()
+    else:
+        clips = torch.from_numpy(frames_buffer.take(frame_indices))
+
+    # B=16 x CROP=10 x CH=3 x T=16 x H x W
+    if feature == "I3D":
+        return transform_clips_i3d(clips, patch_size, n_crops, bgr)
+    else:
+        return transform_clips_c3d(clips, patch_size, n_crops, bgr)